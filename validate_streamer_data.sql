@@ -1,7 +1,6 @@
--- Example: Show all tables for streamers
-SELECT tablename
-FROM pg_tables
-WHERE schemaname = 'public' AND tablename LIKE 'streamer_%';
+-- Example: Show which streamers have data
+SELECT DISTINCT streamer
+FROM streamer_history;
 
--- Example: Show all data for a specific streamer table (replace 'streamer_shroud' with the actual table name)
-SELECT * FROM streamer_XXXXXX;
+-- Example: Show all data for a specific streamer (replace 'shroud' with the actual streamer name)
+SELECT * FROM streamer_history WHERE streamer = 'XXXXXX';